@@ -1,18 +1,59 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from jose import JWTError, jwt
+from uuid import uuid4
+import os
+import time
+from cachetools import TTLCache
+import jwt
+from jwt import InvalidTokenError as JWTError
+from redis.asyncio import Redis
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db
-from models import User, BlacklistedToken
+from models import BlacklistedToken, UserResponse, user_by_email
 
-SECRET_KEY = "your-secret-key-here-change-in-production"
+# Ключ підпису JWT обов'язковий: без JWT_SECRET застосунок не стартує.
+# Публічний dev-ключ дозволено лише явним прапорцем JWT_ALLOW_DEV_SECRET=1
+# (локальний docker-compose, тести)
+DEV_SECRET_KEY = "insecure-dev-secret-do-not-use-in-production"
+SECRET_KEY = os.getenv("JWT_SECRET")
+if not SECRET_KEY:
+    if os.getenv("JWT_ALLOW_DEV_SECRET", "0") != "1":
+        raise RuntimeError("JWT_SECRET is not set (set JWT_ALLOW_DEV_SECRET=1 to use the dev key locally)")
+    SECRET_KEY = DEV_SECRET_KEY
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Чорний список токенів зберігається в Redis: ключ bl:<jti> живе до exp токена
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+BLACKLIST_PREFIX = "bl:"
+
+redis_client = Redis.from_url(REDIS_URL)
+
+# Короткоживучий кеш користувачів за email (sub токена), щоб не робити
+# SELECT users на кожен автентифікований запит. Зберігає UserResponse-знімки
+# (id, username, email), ніколи не ORM-об'єкти, прив'язані до сесії
+USER_CACHE_TTL_SECONDS = 30
+_user_cache: TTLCache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL_SECONDS)
+
 security = HTTPBearer()
 
+# Один контекст на процес: ініціалізація бекенду bcrypt не дешева
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+async def hash_password(password: str) -> str:
+    """Хешування пароля (bcrypt) поза event loop"""
+    return await run_in_threadpool(pwd_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    """Перевірка пароля (bcrypt) поза event loop"""
+    return await run_in_threadpool(pwd_context.verify, password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Створення JWT токена"""
     to_encode = data.copy()
@@ -20,51 +61,75 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str, db: Session) -> Optional[dict]:
+async def verify_token(token: str) -> Optional[dict]:
     """Перевірка JWT токена"""
     try:
-        if is_token_blacklisted(token, db):
-            return None
-            
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        return payload
     except JWTError:
         return None
 
-def is_token_blacklisted(token: str, db: Session) -> bool:
+    username: str = payload.get("sub")
+    jti: str = payload.get("jti")
+    if username is None or jti is None:
+        return None
+    if await is_token_blacklisted(jti):
+        return None
+    return payload
+
+async def is_token_blacklisted(jti: str) -> bool:
     """Перевірка, чи токен в чорному списку"""
-    blacklisted = db.query(BlacklistedToken).filter(
-        BlacklistedToken.token == token
-    ).first()
-    return blacklisted is not None
+    return await redis_client.exists(BLACKLIST_PREFIX + jti) > 0
 
-def add_token_to_blacklist(token: str, db: Session):
+async def add_token_to_blacklist(token: str, db: AsyncSession):
     """Додавання токена в чорний список"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        exp_timestamp = payload.get("exp")
-        if exp_timestamp:
-            expires_at = datetime.fromtimestamp(exp_timestamp)
-        else:
-            expires_at = datetime.utcnow() + timedelta(hours=1)
-    except:
-        expires_at = datetime.utcnow() + timedelta(hours=1)
-    
-    blacklisted_token = BlacklistedToken(
-        token=token,
-        expires_at=expires_at
+    except JWTError:
+        # Недійсний або прострочений токен і так не пройде перевірку
+        return
+
+    _user_cache.pop(payload.get("sub"), None)
+
+    jti = payload.get("jti")
+    exp_timestamp = payload.get("exp")
+    if jti is None or exp_timestamp is None:
+        return
+
+    ttl = int(exp_timestamp - time.time())
+    if ttl > 0:
+        await redis_client.set(BLACKLIST_PREFIX + jti, "1", ex=ttl)
+
+    # Таблиця в Postgres лишається журналом аудиту, на перевірку не впливає
+    await db.execute(
+        pg_insert(BlacklistedToken)
+        .values(jti=jti, expires_at=datetime.fromtimestamp(exp_timestamp, tz=timezone.utc))
+        .on_conflict_do_nothing(index_elements=["jti"])
     )
-    db.add(blacklisted_token)
-    db.commit()
+    await db.commit()
+
+async def restore_blacklist(db: AsyncSession) -> int:
+    """Відновлення ключів bl:<jti> у Redis з журналу blacklisted_tokens (напр. після очищення Redis)"""
+    now = datetime.now(timezone.utc)
+    rows = (await db.execute(
+        select(BlacklistedToken.jti, BlacklistedToken.expires_at)
+        .where(BlacklistedToken.expires_at > now)
+    )).all()
+    if not rows:
+        return 0
 
-def get_current_user(token: str = Depends(security), db: Session = Depends(get_db)) -> User:
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for jti, expires_at in rows:
+            ttl = int(expires_at.timestamp() - time.time())
+            if ttl > 0:
+                pipe.set(BLACKLIST_PREFIX + jti, "1", ex=ttl)
+        await pipe.execute()
+    return len(rows)
+
+async def get_current_user(token: str = Depends(security), db: AsyncSession = Depends(get_db)) -> UserResponse:
     """Отримання поточного користувача з токена"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -72,7 +137,7 @@ def get_current_user(token: str = Depends(security), db: Session = Depends(get_d
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    payload = verify_token(token.credentials, db)
+    payload = await verify_token(token.credentials)
     if payload is None:
         raise credentials_exception
     
@@ -80,13 +145,19 @@ def get_current_user(token: str = Depends(security), db: Session = Depends(get_d
     if username is None:
         raise credentials_exception
     
-    user = db.query(User).filter(User.email == username).first()
+    user = _user_cache.get(username)
     if user is None:
-        raise credentials_exception
+        db_user = await db.scalar(user_by_email, {"email": username})
+        if db_user is None:
+            raise credentials_exception
+        # Кешуємо незалежний від сесії знімок, а не ORM-об'єкт: відкат сесії
+        # в цьому ж запиті expire-ить її об'єкти, і кеш віддавав би "мертвий" User
+        user = UserResponse.model_validate(db_user)
+        _user_cache[username] = user
     
     return user
 
-def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_active_user(current_user: UserResponse = Depends(get_current_user)) -> UserResponse:
     """Отримання активного користувача"""
     if not current_user:
         raise HTTPException(status_code=400, detail="Inactive user")
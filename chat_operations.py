@@ -1,49 +1,63 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
 from fastapi import HTTPException, status, UploadFile
-from models import Chat, Message, ChatMember, FileAttachment, User, ChatType, MemberRole, MemberStatus
+from pydantic import TypeAdapter, ValidationError
+from models import (
+    Chat, Message, FileAttachment, User, ChatType, MSG_TEXT_VALUE, utcnow,
+    AttachmentFilename, MimeType,
+    chat_messages_page, chat_messages_before, chat_messages_search, chat_participant_exists
+)
 from typing import List, Optional
+from cachetools import TTLCache
 import os
-import shutil
-from datetime import datetime
+import aiofiles
+import aiofiles.os
+from uuid import uuid4
 import logging
 
 logger = logging.getLogger(__name__)
 
 UPLOAD_DIR = "uploads"
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-ALLOWED_EXTENSIONS = {".txt", ".pdf", ".doc", ".docx", ".jpg", ".jpeg", ".png", ".gif"}
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+ALLOWED_EXTENSIONS = frozenset({".txt", ".pdf", ".doc", ".docx", ".jpg", ".jpeg", ".png", ".gif"})
+DEFAULT_MIME_TYPE = "application/octet-stream"
+
+# Перевірка клієнтських filename/content-type тими ж обмеженнями, що й у схемах API
+_filename_adapter = TypeAdapter(AttachmentFilename)
+_mime_type_adapter = TypeAdapter(MimeType)
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-def create_private_chat(db: Session, creator_id: int, recipient_id: int) -> Chat:
+# Кеш позитивних перевірок членства (chat_id, user_id). Членство в приватному
+# чаті лише додається, тому від'ємні результати не кешуються, а будь-яке
+# майбутнє блокування (creator_blocked/recipient_blocked) має прибирати ключ з кешу.
+MEMBERSHIP_CACHE_TTL_SECONDS = 60
+_membership_cache: TTLCache = TTLCache(maxsize=10000, ttl=MEMBERSHIP_CACHE_TTL_SECONDS)
+
+async def create_private_chat(db: AsyncSession, creator_id: int, recipient_id: int) -> Chat:
     """Створення приватного чату між двома користувачами"""
-    logger.info(f"🔍 Creating private chat: creator_id={creator_id}, recipient_id={recipient_id}")
-    
-    recipient = db.query(User).filter(User.id == recipient_id).first()
+    recipient = await db.scalar(select(User).where(User.id == recipient_id))
     if not recipient:
-        logger.error(f"❌ Recipient user {recipient_id} not found")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Recipient user not found"
         )
     
     if creator_id == recipient_id:
-        logger.error(f"❌ Cannot create chat with yourself")
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Cannot create chat with yourself"
         )
     
-    existing_chat = db.query(Chat).filter(
+    existing_chat = await db.scalar(select(Chat).where(
         ((Chat.creator_id == creator_id) & (Chat.recipient_id == recipient_id)) |
         ((Chat.creator_id == recipient_id) & (Chat.recipient_id == creator_id)),
-        Chat.chat_type == ChatType.PRIVATE
-    ).first()
+        Chat.chat_type == ChatType.PRIVATE.value
+    ))
     
     if existing_chat:
-        logger.info(f"✅ Found existing chat: {existing_chat.id}")
-        _ensure_user_membership(db, existing_chat.id, creator_id)
-        _ensure_user_membership(db, existing_chat.id, recipient_id)
         return existing_chat
     
     chat = Chat(
@@ -52,112 +66,27 @@ def create_private_chat(db: Session, creator_id: int, recipient_id: int) -> Chat
         recipient_id=recipient_id
     )
     db.add(chat)
-    db.commit()
-    db.refresh(chat)
-    logger.info(f"✅ Chat created: {chat.id}")
-    
-    creator_member = ChatMember(
-        user_id=creator_id,
-        chat_id=chat.id,
-        role=MemberRole.PARTICIPANT,
-        status=MemberStatus.ACTIVE
-    )
-    recipient_member = ChatMember(
-        user_id=recipient_id,
-        chat_id=chat.id,
-        role=MemberRole.PARTICIPANT,
-        status=MemberStatus.ACTIVE
-    )
-    
-    db.add(creator_member)
-    db.add(recipient_member)
-    db.commit()
-    logger.info(f"✅ Members added: creator={creator_id}, recipient={recipient_id}")
+    await db.commit()
+    logger.debug("Chat %s created: creator=%s recipient=%s", chat.id, creator_id, recipient_id)
     
     return chat
 
-def _ensure_user_membership(db: Session, chat_id: int, user_id: int) -> None:
-    """Create ACTIVE participant membership if missing. Safe to call repeatedly."""
-    member = db.query(ChatMember).filter(
-        ChatMember.chat_id == chat_id,
-        ChatMember.user_id == user_id,
-        ChatMember.status == MemberStatus.ACTIVE
-    ).first()
-    if member:
-        return
-    new_member = ChatMember(
-        user_id=user_id,
-        chat_id=chat_id,
-        role=MemberRole.PARTICIPANT,
-        status=MemberStatus.ACTIVE
-    )
-    db.add(new_member)
-    db.commit()
-    logger.info(f"✅ Ensured membership: user={user_id} chat={chat_id}")
-
-def get_or_create_private_chat(db: Session, user_id: int, other_user_id: int) -> Chat:
+async def get_or_create_private_chat(db: AsyncSession, user_id: int, other_user_id: int) -> Chat:
     """Отримання існуючого приватного чату або створення нового"""
-    existing_chat = db.query(Chat).filter(
+    existing_chat = await db.scalar(select(Chat).where(
         ((Chat.creator_id == user_id) & (Chat.recipient_id == other_user_id)) |
         ((Chat.creator_id == other_user_id) & (Chat.recipient_id == user_id)),
-        Chat.chat_type == ChatType.PRIVATE
-    ).first()
+        Chat.chat_type == ChatType.PRIVATE.value
+    ))
     
     if existing_chat:
         return existing_chat
     
-    return create_private_chat(db, user_id, other_user_id)
-
-def add_member_to_chat(db: Session, chat_id: int, user_id: int, role: str = "participant") -> ChatMember:
-    """Додавання учасника до чату (для приватних чатів зазвичай не потрібно)"""
-    existing_member = db.query(ChatMember).filter(
-        ChatMember.chat_id == chat_id,
-        ChatMember.user_id == user_id
-    ).first()
-    
-    if existing_member:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="User is already a member of this chat"
-        )
-    
-    member = ChatMember(
-        user_id=user_id,
-        chat_id=chat_id,
-        role=MemberRole.PARTICIPANT,
-        status=MemberStatus.ACTIVE
-    )
-    db.add(member)
-    db.commit()
-    db.refresh(member)
-    
-    return member
+    return await create_private_chat(db, user_id, other_user_id)
 
-def send_message(db: Session, message_data: dict, author_id: int) -> Message:
+async def send_message(db: AsyncSession, message_data: dict, author_id: int) -> Message:
     """Відправлення повідомлення"""
-    logger.info(f"🔍 Sending message: chat_id={message_data['chat_id']}, author_id={author_id}")
-    
-    member = db.query(ChatMember).filter(
-        ChatMember.chat_id == message_data["chat_id"],
-        ChatMember.user_id == author_id,
-        ChatMember.status == MemberStatus.ACTIVE
-    ).first()
-    if not member:
-        chat = db.query(Chat).filter(Chat.id == message_data["chat_id"]).first()
-        if chat and (chat.creator_id == author_id or chat.recipient_id == author_id):
-            try:
-                _ensure_user_membership(db, chat.id, author_id)
-                member = db.query(ChatMember).filter(
-                    ChatMember.chat_id == message_data["chat_id"],
-                    ChatMember.user_id == author_id,
-                    ChatMember.status == MemberStatus.ACTIVE
-                ).first()
-            except Exception as e:
-                logger.error(f"⚠️ Failed to ensure membership before sending: {e}")
-        
-    logger.info(f"🔍 Chat member check after ensure: {member}")
-    if not member:
-        logger.error(f"❌ User {author_id} is not a member of chat {message_data['chat_id']}")
+    if not await is_user_in_chat(db, message_data["chat_id"], author_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this chat"
@@ -165,20 +94,30 @@ def send_message(db: Session, message_data: dict, author_id: int) -> Message:
     
     message = Message(
         content=message_data["content"],
-        message_type=message_data.get("message_type", "text"),
+        message_type=message_data.get("message_type", MSG_TEXT_VALUE),
         author_id=author_id,
         chat_id=message_data["chat_id"]
     )
     db.add(message)
-    db.commit()
-    db.refresh(message)
+    await db.flush()  # id і created_at потрібні для денормалізації в chats
+    # Покажчик лише рухається вперед: паралельна відправка з меншим id,
+    # що закомітилась пізніше, не перезапише новіше останнє повідомлення
+    await db.execute(
+        update(Chat)
+        .where(
+            Chat.id == message.chat_id,
+            or_(Chat.last_message_id.is_(None), Chat.last_message_id < message.id)
+        )
+        .values(last_message_at=message.created_at, last_message_id=message.id)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
     
-    logger.info(f"✅ Message sent: {message.id}")
     return message
 
-def edit_message(db: Session, message_id: int, new_content: str, user_id: int) -> Message:
+async def edit_message(db: AsyncSession, message_id: int, new_content: str, user_id: int) -> Message:
     """Редагування повідомлення"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.scalar(select(Message).where(Message.id == message_id))
     
     if not message:
         raise HTTPException(
@@ -199,15 +138,14 @@ def edit_message(db: Session, message_id: int, new_content: str, user_id: int) -
         )
     
     message.content = new_content
-    message.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(message)
+    message.updated_at = utcnow()
+    await db.commit()
     
     return message
 
-def delete_message(db: Session, message_id: int, user_id: int) -> bool:
+async def delete_message(db: AsyncSession, message_id: int, user_id: int) -> bool:
     """Видалення повідомлення (soft delete)"""
-    message = db.query(Message).filter(Message.id == message_id).first()
+    message = await db.scalar(select(Message).where(Message.id == message_id))
     
     if not message:
         raise HTTPException(
@@ -222,11 +160,19 @@ def delete_message(db: Session, message_id: int, user_id: int) -> bool:
         )
     
     message.is_deleted = True
-    db.commit()
+    await db.commit()
     
     return True
 
-def upload_file(db: Session, file: UploadFile, message_id: int) -> FileAttachment:
+def _normalize_mime_type(content_type: Optional[str]) -> str:
+    """MIME-тип без параметрів (charset тощо); некоректний замінюється на DEFAULT_MIME_TYPE"""
+    mime_type = (content_type or "").partition(";")[0].strip()
+    try:
+        return _mime_type_adapter.validate_python(mime_type)
+    except ValidationError:
+        return DEFAULT_MIME_TYPE
+
+async def upload_file(db: AsyncSession, file: UploadFile, message_id: int) -> FileAttachment:
     """Завантаження файлу"""
     if file.size and file.size > MAX_FILE_SIZE:
         raise HTTPException(
@@ -234,110 +180,103 @@ def upload_file(db: Session, file: UploadFile, message_id: int) -> FileAttachmen
             detail="File size exceeds maximum allowed size"
         )
     
-    file_extension = os.path.splitext(file.filename)[1].lower()
-    if file_extension not in ALLOWED_EXTENSIONS:
+    try:
+        filename = _filename_adapter.validate_python(file.filename or "")
+    except ValidationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="File type not allowed"
+            detail="Invalid file name"
         )
     
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    safe_filename = f"{timestamp}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, safe_filename)
+    _, dot, extension = filename.rpartition(".")
+    file_extension = "." + extension.lower()
+    if not dot or file_extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File type not allowed"
+        )
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Ім'я на диску не залежить від клієнта й не колізує; файли розкладаються
+    # по підкаталогах uploads/ab/cd/, щоб каталоги не розросталися
+    stored_name = uuid4().hex
+    upload_subdir = os.path.join(UPLOAD_DIR, stored_name[:2], stored_name[2:4])
+    await aiofiles.os.makedirs(upload_subdir, exist_ok=True)
+    file_path = os.path.join(upload_subdir, stored_name + file_extension)
+    
+    # Пишемо потоково частинами, рахуючи розмір: file.size може бути невідомим
+    total = 0
+    async with aiofiles.open(file_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            total += len(chunk)
+            if total > MAX_FILE_SIZE:
+                break
+            await buffer.write(chunk)
+
+    if total > MAX_FILE_SIZE:
+        await aiofiles.os.remove(file_path)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="File size exceeds maximum allowed size"
+        )
     
     attachment = FileAttachment(
-        filename=file.filename,
+        filename=filename,
         file_path=file_path,
-        file_size=os.path.getsize(file_path),
-        mime_type=file.content_type or "application/octet-stream",
+        file_size=total,
+        mime_type=_normalize_mime_type(file.content_type),
         message_id=message_id
     )
     db.add(attachment)
-    db.commit()
-    db.refresh(attachment)
+    await db.commit()
     
     return attachment
 
-def get_chat_messages(db: Session, chat_id: int, skip: int = 0, limit: int = 50) -> List[Message]:
-    """Отримання повідомлень чату"""
-    messages = db.query(Message).filter(
-        Message.chat_id == chat_id,
-        Message.is_deleted == False
-    ).order_by(Message.created_at.desc()).offset(skip).limit(limit).all()
-    
-    return messages
-
-def get_user_chats(db: Session, user_id: int) -> List[Chat]:
-    """Отримання приватних чатів користувача"""
-    logger.info(f"🔍 Getting chats for user {user_id}")
-    member_rows = db.query(ChatMember).filter(
-        ChatMember.user_id == user_id,
-        ChatMember.status == MemberStatus.ACTIVE
-    ).all()
-    member_chat_ids = {row.chat_id for row in member_rows}
+async def get_chat_messages(db: AsyncSession, chat_id: int, before_id: Optional[int] = None, limit: int = 50) -> List[Message]:
+    """Отримання повідомлень чату (keyset-пагінація: before_id - id найстарішого вже отриманого)"""
+    if before_id is None:
+        stmt, params = chat_messages_page, {"chat_id": chat_id, "limit": limit}
+    else:
+        stmt, params = chat_messages_before, {"chat_id": chat_id, "before_id": before_id, "limit": limit}
+    result = await db.execute(stmt, params)
+    
+    return list(result.scalars().all())
 
-    implicit_chats = db.query(Chat).filter(
-        (Chat.creator_id == user_id) | (Chat.recipient_id == user_id)
-    ).all()
-    implicit_chat_ids = {c.id for c in implicit_chats}
+async def search_chat_messages(db: AsyncSession, chat_id: int, query: str, limit: int = 50) -> List[Message]:
+    """Повнотекстовий пошук повідомлень чату (GIN-індекс по content_tsv)"""
+    result = await db.execute(chat_messages_search, {"chat_id": chat_id, "query": query, "limit": limit})
 
-    for chat in implicit_chats:
-        try:
-            _ensure_user_membership(db, chat.id, chat.creator_id)
-            _ensure_user_membership(db, chat.id, chat.recipient_id)
-        except Exception as e:
-            logger.error(f"⚠️ Failed to ensure membership for chat {chat.id}: {e}")
+    return list(result.scalars().all())
 
-    all_chat_ids = list(member_chat_ids | implicit_chat_ids)
-    if not all_chat_ids:
-        logger.info("🔍 No chats found for user")
-        return []
-
-    chats = db.query(Chat).filter(
-        Chat.id.in_(all_chat_ids)
-    ).all()
-    logger.info(f"🔍 Chats found: {[c.id for c in chats]}")
+async def get_user_chats(db: AsyncSession, user_id: int) -> List[Chat]:
+    """Отримання приватних чатів користувача (спочатку з найсвіжішими повідомленнями)"""
+    # Учасники приватного чату - creator і recipient, якщо їх не заблоковано
+    chats = list((await db.execute(select(Chat).options(raiseload("*")).where(
+        or_(
+            (Chat.creator_id == user_id) & (Chat.creator_blocked == False),
+            (Chat.recipient_id == user_id) & (Chat.recipient_blocked == False)
+        )
+    ).order_by(Chat.last_message_at.desc().nulls_last(), Chat.id.desc()))).scalars().all())
     return chats
 
-def get_chat_participants(db: Session, chat_id: int) -> List[User]:
+async def get_chat_participants(db: AsyncSession, chat_id: int) -> List[User]:
     """Отримання учасників приватного чату"""
-    members = db.query(ChatMember).filter(
-        ChatMember.chat_id == chat_id,
-        ChatMember.status == MemberStatus.ACTIVE
-    ).all()
-    
-    user_ids = [member.user_id for member in members]
-    users = db.query(User).filter(User.id.in_(user_ids)).all()
+    users = await db.execute(
+        select(User)
+        .join(Chat, or_(
+            (User.id == Chat.creator_id) & (Chat.creator_blocked == False),
+            (User.id == Chat.recipient_id) & (Chat.recipient_blocked == False)
+        ))
+        .where(Chat.id == chat_id)
+    )
     
-    return users
+    return list(users.scalars().all())
 
-def is_user_in_chat(db: Session, chat_id: int, user_id: int) -> bool:
+async def is_user_in_chat(db: AsyncSession, chat_id: int, user_id: int) -> bool:
     """Перевірка, чи користувач є учасником чату"""
-    logger.info(f"🔍 Checking if user {user_id} is in chat {chat_id}")
-    member = db.query(ChatMember).filter(
-        ChatMember.chat_id == chat_id,
-        ChatMember.user_id == user_id,
-        ChatMember.status == MemberStatus.ACTIVE
-    ).first()
-    if member:
-        logger.info("🔍 Member row exists: True")
-        return True
-        
-    chat = db.query(Chat).filter(Chat.id == chat_id).first()
-    if not chat:
-        logger.info("🔍 Chat not found or not private")
-        return False
-
-    if chat.creator_id == user_id or chat.recipient_id == user_id:
-        logger.info("🔍 Implicit membership via chat creator/recipient: True")
-        try:
-            _ensure_user_membership(db, chat_id, user_id)
-        except Exception as e:
-            logger.error(f"⚠️ Failed to ensure membership row: {e}")
+    if (chat_id, user_id) in _membership_cache:
         return True
 
-    logger.info("🔍 User is NOT in chat")
-    return False
+    is_member = bool(await db.scalar(chat_participant_exists, {"chat_id": chat_id, "user_id": user_id}))
+    if is_member:
+        _membership_cache[(chat_id, user_id)] = True
+    return is_member
@@ -98,7 +98,7 @@ const Messenger: React.FC = () => {
 
   const getMessageAuthor = (message: Message) => {
     if (message.author_id === user?.id) return 'Ви';
-    const author = users.find(u => u.id === message.author_id);
+    const author = message.author ?? users.find(u => u.id === message.author_id);
     return author?.username || `User ${message.author_id}`;
   };
 
@@ -106,8 +106,17 @@ class ApiService {
     return this.handleResponse<Message>(response);
   }
 
-  async getChatMessages(chatId: number, skip = 0, limit = 50): Promise<Message[]> {
-    const response = await fetch(`${API_BASE}/chats/${chatId}/messages?skip=${skip}&limit=${limit}`, {
+  async getChatMessages(chatId: number, beforeId?: number, limit = 50): Promise<Message[]> {
+    const cursor = beforeId !== undefined ? `&before_id=${beforeId}` : '';
+    const response = await fetch(`${API_BASE}/chats/${chatId}/messages?limit=${limit}${cursor}`, {
+      headers: this.getAuthHeaders()
+    });
+    return this.handleResponse<Message[]>(response);
+  }
+
+  async searchChatMessages(chatId: number, query: string, limit = 50): Promise<Message[]> {
+    const params = new URLSearchParams({ q: query, limit: String(limit) });
+    const response = await fetch(`${API_BASE}/chats/${chatId}/messages/search?${params}`, {
       headers: this.getAuthHeaders()
     });
     return this.handleResponse<Message[]>(response);
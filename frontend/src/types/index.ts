@@ -15,6 +15,12 @@ export interface Chat {
   recipient_id: number;
   created_at: string;
   is_active: boolean;
+  last_message_at?: string | null;
+}
+
+export interface UserRef {
+  id: number;
+  username: string;
 }
 
 export interface Message {
@@ -26,6 +32,7 @@ export interface Message {
   created_at: string;
   updated_at?: string;
   is_deleted: boolean;
+  author?: UserRef | null;
 }
 
 export interface FileAttachment {
@@ -38,15 +45,6 @@ export interface FileAttachment {
   uploaded_at: string;
 }
 
-export interface ChatMember {
-  id: number;
-  user_id: number;
-  chat_id: number;
-  role: 'participant';
-  status: 'active' | 'blocked' | 'left';
-  joined_at: string;
-}
-
 export interface AuthResponse {
   access_token: string;
   token_type: string;
@@ -0,0 +1,161 @@
+-- Міграція існуючої бази (створеної create_all зі старих моделей) до поточної схеми.
+--
+-- Base.metadata.create_all створює відсутні таблиці, але ніколи не змінює наявні.
+-- Для бази з даними (наприклад, том pgdata у docker-compose) цей скрипт доводить
+-- схему до поточних моделей. З RUN_MIGRATIONS=1 застосунок виконує його при
+-- старті одразу після create_all; вручну:
+--
+--   psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f migrations/001_backlog_schema.sql
+--
+-- Скрипт ідемпотентний (IF [NOT] EXISTS, перевірки в DO-блоках) і виконується
+-- в одній транзакції. Дорогі кроки (перезапис таблиць, перевірка FK, backfill)
+-- виконуються лише для ще не мігрованої бази, тож повторний запуск дешевий.
+-- Кроки впорядковані так само, як зміни схеми в історії.
+
+BEGIN;
+
+-- 1. blacklisted_tokens: замість самого JWT зберігається лише jti.
+--    Старі записи jti не мають, а токени без jti verify_token і так відхиляє,
+--    тож вони більше нічого не блокують і просто видаляються.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'blacklisted_tokens' AND column_name = 'jti'
+    ) THEN
+        DELETE FROM blacklisted_tokens;
+        ALTER TABLE blacklisted_tokens ADD COLUMN jti VARCHAR(32) NOT NULL;
+    END IF;
+END $$;
+DROP INDEX IF EXISTS ix_blacklisted_tokens_token;
+ALTER TABLE blacklisted_tokens DROP COLUMN IF EXISTS token;
+CREATE UNIQUE INDEX IF NOT EXISTS ix_blacklisted_tokens_jti ON blacklisted_tokens (jti);
+CREATE INDEX IF NOT EXISTS ix_blacklisted_expires ON blacklisted_tokens (expires_at);
+
+-- 2. Нативні enum-и -> VARCHAR(16) зі значеннями в нижньому регістрі.
+--    SQLAlchemy Enum зберігав імена членів ('PRIVATE', 'TEXT'), а запити тепер
+--    порівнюють зі значеннями ('private', 'text'): без lower() старі чати не
+--    знаходяться, і create_private_chat створює дублікати.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'chats' AND column_name = 'chat_type' AND data_type = 'USER-DEFINED'
+    ) THEN
+        ALTER TABLE chats ALTER COLUMN chat_type TYPE VARCHAR(16) USING lower(chat_type::text);
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'messages' AND column_name = 'message_type' AND data_type = 'USER-DEFINED'
+    ) THEN
+        ALTER TABLE messages ALTER COLUMN message_type TYPE VARCHAR(16) USING lower(message_type::text);
+    END IF;
+END $$;
+
+-- 3. Обмеження довжини рядків (валідація в API відповідає цим розмірам)
+ALTER TABLE users ALTER COLUMN username TYPE VARCHAR(64);
+ALTER TABLE users ALTER COLUMN email TYPE VARCHAR(254);
+ALTER TABLE file_attachments ALTER COLUMN filename TYPE VARCHAR(255);
+ALTER TABLE file_attachments ALTER COLUMN file_path TYPE VARCHAR(255);
+ALTER TABLE file_attachments ALTER COLUMN mime_type TYPE VARCHAR(255);
+
+-- 4. Дублюючі індекси первинних ключів (PK уже має унікальний індекс)
+DROP INDEX IF EXISTS ix_users_id;
+DROP INDEX IF EXISTS ix_chats_id;
+DROP INDEX IF EXISTS ix_messages_id;
+DROP INDEX IF EXISTS ix_file_attachments_id;
+DROP INDEX IF EXISTS ix_blacklisted_tokens_id;
+
+-- 5. Час створення/оновлення обчислює застосунок, серверні DEFAULT now() не потрібні
+ALTER TABLE users ALTER COLUMN created_at DROP DEFAULT;
+ALTER TABLE chats ALTER COLUMN created_at DROP DEFAULT;
+ALTER TABLE messages ALTER COLUMN created_at DROP DEFAULT;
+ALTER TABLE file_attachments ALTER COLUMN uploaded_at DROP DEFAULT;
+ALTER TABLE blacklisted_tokens ALTER COLUMN blacklisted_at DROP DEFAULT;
+
+-- 6. Індекси пошуку приватного чату та стрічки повідомлень (keyset по id)
+CREATE INDEX IF NOT EXISTS ix_chats_creator_recipient ON chats (creator_id, recipient_id, is_active);
+DROP INDEX IF EXISTS ix_message_chat_created;
+CREATE INDEX IF NOT EXISTS ix_message_chat_id_live ON messages (chat_id, id) WHERE is_deleted = false;
+
+-- 7. Повнотекстовий пошук: згенерована колонка tsvector + GIN
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED;
+CREATE INDEX IF NOT EXISTS ix_messages_content_tsv ON messages USING gin (content_tsv);
+
+-- 8. Останнє повідомлення чату, денормалізоване в chats
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'chats' AND column_name = 'last_message_id'
+    ) THEN
+        ALTER TABLE chats ADD COLUMN last_message_at TIMESTAMP WITH TIME ZONE;
+        ALTER TABLE chats ADD COLUMN last_message_id INTEGER;
+        UPDATE chats c
+        SET last_message_id = m.id, last_message_at = m.created_at
+        FROM (
+            SELECT DISTINCT ON (chat_id) chat_id, id, created_at
+            FROM messages
+            ORDER BY chat_id, id DESC
+        ) m
+        WHERE m.chat_id = c.id;
+    END IF;
+END $$;
+CREATE INDEX IF NOT EXISTS ix_chats_user_last ON chats (recipient_id, last_message_at);
+
+-- 9. Членство в чаті живе в рядку chats: блокування переноситься з chat_members,
+--    після чого таблиця та її enum-типи видаляються
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS creator_blocked BOOLEAN NOT NULL DEFAULT false;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS recipient_blocked BOOLEAN NOT NULL DEFAULT false;
+DO $$
+BEGIN
+    IF to_regclass('chat_members') IS NOT NULL THEN
+        UPDATE chats c
+        SET creator_blocked = c.creator_blocked OR EXISTS (
+                SELECT 1 FROM chat_members cm
+                WHERE cm.chat_id = c.id AND cm.user_id = c.creator_id
+                  AND lower(cm.status::text) = 'blocked'
+            ),
+            recipient_blocked = c.recipient_blocked OR EXISTS (
+                SELECT 1 FROM chat_members cm
+                WHERE cm.chat_id = c.id AND cm.user_id = c.recipient_id
+                  AND lower(cm.status::text) = 'blocked'
+            );
+    END IF;
+END $$;
+DROP TABLE IF EXISTS chat_members;
+
+DROP TYPE IF EXISTS chattype;
+DROP TYPE IF EXISTS messagetype;
+DROP TYPE IF EXISTS memberrole;
+DROP TYPE IF EXISTS memberstatus;
+
+-- 10. Каскадне видалення виконує БД (ON DELETE CASCADE), а видалене
+--     останнє повідомлення обнуляє покажчик у chats. FK перестворюється лише
+--     тоді, коли правило ON DELETE ще старе (перевірка FK читає всю таблицю)
+CREATE OR REPLACE FUNCTION pg_temp.ensure_fk(tbl text, con text, definition text, deltype "char")
+RETURNS void LANGUAGE plpgsql AS $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = con AND conrelid = tbl::regclass AND confdeltype = deltype
+    ) THEN
+        EXECUTE format('ALTER TABLE %I DROP CONSTRAINT IF EXISTS %I', tbl, con);
+        EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I %s', tbl, con, definition);
+    END IF;
+END $$;
+DO $$
+BEGIN
+    PERFORM pg_temp.ensure_fk('messages', 'messages_author_id_fkey',
+        'FOREIGN KEY (author_id) REFERENCES users (id) ON DELETE CASCADE', 'c');
+    PERFORM pg_temp.ensure_fk('messages', 'messages_chat_id_fkey',
+        'FOREIGN KEY (chat_id) REFERENCES chats (id) ON DELETE CASCADE', 'c');
+    PERFORM pg_temp.ensure_fk('file_attachments', 'file_attachments_message_id_fkey',
+        'FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE', 'c');
+    PERFORM pg_temp.ensure_fk('chats', 'fk_chats_last_message_id',
+        'FOREIGN KEY (last_message_id) REFERENCES messages (id) ON DELETE SET NULL', 'n');
+END $$;
+DROP FUNCTION pg_temp.ensure_fk(text, text, text, "char");
+
+COMMIT;
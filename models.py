@@ -1,12 +1,32 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Enum
-from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from pydantic import BaseModel, ConfigDict, EmailStr, StringConstraints, TypeAdapter
+from typing import Annotated, Optional, List
+from sqlalchemy import Integer, String, DateTime, Boolean, Computed, ForeignKey, Text, Index, bindparam, exists, false, func, inspect, lambda_stmt, literal_column, or_, select, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import Mapped, joinedload, mapped_column, raiseload, relationship, validates
 from database import Base
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
 import enum
 
+# Розміри рядкових колонок (мають збігатися з обмеженнями у схемах API)
+USERNAME_MAX_LENGTH = 64
+EMAIL_MAX_LENGTH = 254
+
+# Спрощена перевірка email (підмножина RFC 5321) для гарячого шляху логіну
+EMAIL_RE = r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$'
+LoginEmail = Annotated[str, StringConstraints(pattern=EMAIL_RE, max_length=EMAIL_MAX_LENGTH)]
+
+# Шаблони для вкладень. pydantic-core виконує їх Rust-рушієм regex (лінійний час,
+# без backtracking), тож клієнтські filename/content-type не можуть його "підвісити"
+FILENAME_RE = r'^[^/\\\x00]+$'
+MIME_TYPE_RE = r'^[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*/[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*$'
+AttachmentFilename = Annotated[str, StringConstraints(min_length=1, max_length=255, pattern=FILENAME_RE)]
+MimeType = Annotated[str, StringConstraints(max_length=255, pattern=MIME_TYPE_RE)]
+
+def utcnow() -> datetime:
+    """Поточний час в UTC; мітки часу рахуються на боці застосунку, без RETURNING"""
+    return datetime.now(timezone.utc)
+
 # Enums
 class ChatType(str, enum.Enum):
     PRIVATE = "private"  # Тільки приватні чати для месенджера
@@ -16,30 +36,42 @@ class MessageType(str, enum.Enum):
     FILE = "file"
     SYSTEM = "system"
 
-class MemberRole(str, enum.Enum):
-    PARTICIPANT = "participant"  # Спрощуємо ролі для приватних чатів
-
-class MemberStatus(str, enum.Enum):
-    ACTIVE = "active"
-    BLOCKED = "blocked"
-    LEFT = "left"
+# Готові значення для гарячого шляху повідомлень: без виклику конструктора Enum
+MSG_TEXT = MessageType.TEXT
+MSG_TEXT_VALUE = MessageType.TEXT.value
 
 # Pydantic моделі для API
+class BaseResponse(BaseModel):
+    """Спільна конфігурація відповідей: читання з ORM-атрибутів, незмінні екземпляри"""
+    model_config = ConfigDict(from_attributes=True, use_enum_values=True, frozen=True)
+
+    @classmethod
+    def from_orm_fast(cls, obj):
+        """Швидка побудова відповіді з ORM-об'єкта без повторної валідації"""
+        # Рядки з БД вже пройшли обмеження схеми, тож model_construct безпечний
+        return cls.model_construct(**{name: getattr(obj, name) for name in cls.model_fields})
+
 class UserBase(BaseModel):
     username: str
-    email: EmailStr
+    email: str  # Відповіді віддають email з БД, повторна перевірка не потрібна
 
 class UserCreate(UserBase):
+    username: Annotated[str, StringConstraints(max_length=USERNAME_MAX_LENGTH)]
+    email: EmailStr  # Повна перевірка лише при реєстрації (email-validator обмежує довжину 254)
     password: str
 
-class UserResponse(UserBase):
+class UserResponse(UserBase, BaseResponse):
     id: int
 
-    class Config:
-        from_attributes = True
+class UserRef(BaseModel):
+    """Пласке посилання на користувача для вкладення у відповіді (без email тощо)"""
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+    id: int
+    username: str
 
 class UserLogin(BaseModel):
-    email: EmailStr
+    email: LoginEmail
     password: str
 
 class Token(BaseModel):
@@ -58,156 +90,225 @@ class ChatBase(BaseModel):
 class ChatCreate(ChatBase):
     recipient_id: int  # ID користувача, з яким створюємо чат
 
-class ChatResponse(ChatBase):
+class ChatResponse(ChatBase, BaseResponse):
     id: int
     creator_id: int
     recipient_id: int
     created_at: datetime
     is_active: bool
-
-    class Config:
-        from_attributes = True
+    last_message_at: Optional[datetime] = None
 
 # Message моделі
 class MessageBase(BaseModel):
     content: str
-    message_type: MessageType = MessageType.TEXT
+    message_type: MessageType = MSG_TEXT
 
 class MessageCreate(MessageBase):
     chat_id: int
 
-class MessageResponse(MessageBase):
+class MessageResponse(MessageBase, BaseResponse):
     id: int
     author_id: int
     chat_id: int
     created_at: datetime
     updated_at: Optional[datetime]
     is_deleted: bool
-
-    class Config:
-        from_attributes = True
+    author: Optional[UserRef] = None
+
+    @classmethod
+    def from_orm_fast(cls, obj, author=None):
+        # Вкладений автор теж без валідації: явно переданий (будь-що з id і
+        # username) або з зв'язку, лише якщо його вже завантажено (joinedload),
+        # щоб не спровокувати lazy-запит
+        if author is None and "author" not in inspect(obj).unloaded:
+            author = obj.author
+        fields = {name: getattr(obj, name) for name in cls.model_fields if name != "author"}
+        return cls.model_construct(
+            **fields,
+            author=None if author is None else UserRef.model_construct(id=author.id, username=author.username)
+        )
 
 # File Attachment моделі
 class FileAttachmentBase(BaseModel):
-    filename: str
+    filename: AttachmentFilename
     file_path: str
     file_size: int
-    mime_type: str
+    mime_type: MimeType
 
 class FileAttachmentCreate(FileAttachmentBase):
     message_id: int
 
-class FileAttachmentResponse(FileAttachmentBase):
+class FileAttachmentResponse(FileAttachmentBase, BaseResponse):
     id: int
     message_id: int
     uploaded_at: datetime
 
-    class Config:
-        from_attributes = True
-
-# Chat Member моделі
-class ChatMemberBase(BaseModel):
-    role: MemberRole = MemberRole.PARTICIPANT
-    status: MemberStatus = MemberStatus.ACTIVE
-
-class ChatMemberCreate(ChatMemberBase):
-    user_id: int
-    chat_id: int
-
-class ChatMemberResponse(ChatMemberBase):
-    id: int
-    user_id: int
-    chat_id: int
-    joined_at: datetime
-
-    class Config:
-        from_attributes = True
-
 # SQLAlchemy моделі для бази даних
 class User(Base):
     __tablename__ = "users"
     
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, index=True, nullable=False)
-    email = Column(String, unique=True, index=True, nullable=False)
-    password = Column(String, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    username: Mapped[str] = mapped_column(String(USERNAME_MAX_LENGTH), unique=True, index=True)
+    email: Mapped[str] = mapped_column(String(EMAIL_MAX_LENGTH), unique=True, index=True)
+    password: Mapped[str] = mapped_column(String)
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), insert_default=utcnow, init=False)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), onupdate=utcnow, init=False)
     
     # Relationships
-    messages = relationship("Message", back_populates="author")
-    created_chats = relationship("Chat", foreign_keys="Chat.creator_id", back_populates="creator")
-    received_chats = relationship("Chat", foreign_keys="Chat.recipient_id", back_populates="recipient")
-    chat_memberships = relationship("ChatMember", back_populates="user")
+    # Зв'язки не завантажуються неявно: lazy="raise" робить випадковий N+1 помилкою,
+    # а потрібні дані підтягуються явно (selectinload/joinedload) у конкретному запиті.
+    # Каскадне видалення дочірніх рядків виконує БД (ON DELETE CASCADE, passive_deletes)
+    messages: Mapped[List["Message"]] = relationship(
+        back_populates="author", lazy="raise", cascade="all, delete", passive_deletes=True, init=False, repr=False
+    )
+    created_chats: Mapped[List["Chat"]] = relationship(foreign_keys="Chat.creator_id", back_populates="creator", lazy="raise", init=False, repr=False)
+    received_chats: Mapped[List["Chat"]] = relationship(foreign_keys="Chat.recipient_id", back_populates="recipient", lazy="raise", init=False, repr=False)
 
 class Chat(Base):
     __tablename__ = "chats"
+    __table_args__ = (
+        # Пошук приватного чату між двома користувачами
+        Index("ix_chats_creator_recipient", "creator_id", "recipient_id", "is_active"),
+        # Чати отримувача, впорядковані за останнім повідомленням
+        Index("ix_chats_user_last", "recipient_id", "last_message_at"),
+    )
     
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=True)  # Може бути None для приватних чатів
-    description = Column(Text, nullable=True)
-    chat_type = Column(Enum(ChatType), nullable=False, default=ChatType.PRIVATE)
-    creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # Додаємо recipient_id
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    is_active = Column(Boolean, default=True)
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    name: Mapped[Optional[str]] = mapped_column(String, default=None)  # Може бути None для приватних чатів
+    description: Mapped[Optional[str]] = mapped_column(Text, default=None)
+    chat_type: Mapped[str] = mapped_column(String(16), default=ChatType.PRIVATE.value)
+    creator_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    recipient_id: Mapped[int] = mapped_column(ForeignKey("users.id"))  # Додаємо recipient_id
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), insert_default=utcnow, init=False)
+    is_active: Mapped[Optional[bool]] = mapped_column(Boolean, default=True)
+    # Учасники приватного чату - це creator і recipient; окрема таблиця членства не потрібна
+    creator_blocked: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+    recipient_blocked: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false())
+    # Денормалізовано з messages: оновлюється в send_message, щоб список чатів
+    # сортувався без MAX(...) по повідомленнях
+    last_message_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), default=None, init=False)
+    last_message_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("messages.id", ondelete="SET NULL", use_alter=True, name="fk_chats_last_message_id"), default=None, init=False
+    )
     
     # Relationships
-    creator = relationship("User", foreign_keys=[creator_id], back_populates="created_chats")
-    recipient = relationship("User", foreign_keys=[recipient_id], back_populates="received_chats")
-    messages = relationship("Message", back_populates="chat")
-    members = relationship("ChatMember", back_populates="chat")
+    creator: Mapped["User"] = relationship(foreign_keys=[creator_id], back_populates="created_chats", lazy="raise", init=False, repr=False)
+    recipient: Mapped["User"] = relationship(foreign_keys=[recipient_id], back_populates="received_chats", lazy="raise", init=False, repr=False)
+    messages: Mapped[List["Message"]] = relationship(
+        foreign_keys="Message.chat_id", back_populates="chat", lazy="raise",
+        cascade="all, delete", passive_deletes=True, init=False, repr=False
+    )
+
+    @validates("chat_type")
+    def _validate_chat_type(self, key, value):
+        return ChatType(value).value
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Стрічка повідомлень чату (keyset по id): тільки не видалені
+        Index(
+            "ix_message_chat_id_live", "chat_id", "id",
+            postgresql_where=text("is_deleted = false")
+        ),
+        # Повнотекстовий пошук по повідомленнях
+        Index("ix_messages_content_tsv", "content_tsv", postgresql_using="gin"),
+    )
+    # Інакше (eager_defaults="auto") INSERT додає content_tsv у RETURNING і тягне
+    # згенерований tsvector назад на кожну відправку; id повертається й так
+    __mapper_args__ = {"eager_defaults": False}
     
-    id = Column(Integer, primary_key=True, index=True)
-    content = Column(Text, nullable=False)
-    message_type = Column(Enum(MessageType), default=MessageType.TEXT)
-    author_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
-    is_deleted = Column(Boolean, default=False)
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    content: Mapped[str] = mapped_column(Text)
+    message_type: Mapped[Optional[str]] = mapped_column(String(16), default=MSG_TEXT_VALUE)
+    author_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    chat_id: Mapped[int] = mapped_column(ForeignKey("chats.id", ondelete="CASCADE"))
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), insert_default=utcnow, init=False)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), onupdate=utcnow, init=False)
+    is_deleted: Mapped[Optional[bool]] = mapped_column(Boolean, default=False)
+    # Генерується в БД з content; deferred - у звичайних SELECT не вибирається
+    content_tsv: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR, Computed("to_tsvector('simple', content)", persisted=True),
+        deferred=True, init=False, repr=False
+    )
     
     # Relationships
-    author = relationship("User", back_populates="messages")
-    chat = relationship("Chat", back_populates="messages")
-    attachments = relationship("FileAttachment", back_populates="message")
+    author: Mapped["User"] = relationship(back_populates="messages", lazy="joined", init=False, repr=False)  # many-to-one: один JOIN замість SELECT на рядок
+    chat: Mapped["Chat"] = relationship(foreign_keys=[chat_id], back_populates="messages", lazy="raise", init=False, repr=False)
+    attachments: Mapped[List["FileAttachment"]] = relationship(
+        back_populates="message", lazy="raise", cascade="all, delete", passive_deletes=True, init=False, repr=False
+    )
+
+    @validates("message_type")
+    def _validate_message_type(self, key, value):
+        return MessageType(value).value
 
 class FileAttachment(Base):
     __tablename__ = "file_attachments"
     
-    id = Column(Integer, primary_key=True, index=True)
-    filename = Column(String, nullable=False)
-    file_path = Column(String, nullable=False)
-    file_size = Column(Integer, nullable=False)
-    mime_type = Column(String, nullable=False)
-    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
-    uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
-    
-    # Relationships
-    message = relationship("Message", back_populates="attachments")
-
-class ChatMember(Base):
-    __tablename__ = "chat_members"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
-    role = Column(Enum(MemberRole), default=MemberRole.PARTICIPANT)
-    status = Column(Enum(MemberStatus), default=MemberStatus.ACTIVE)
-    joined_at = Column(DateTime(timezone=True), server_default=func.now())
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    filename: Mapped[str] = mapped_column(String(255))
+    file_path: Mapped[str] = mapped_column(String(255))
+    file_size: Mapped[int] = mapped_column(Integer)
+    mime_type: Mapped[str] = mapped_column(String(255))  # type/subtype, до 127 символів кожен (RFC 6838)
+    message_id: Mapped[int] = mapped_column(ForeignKey("messages.id", ondelete="CASCADE"))
+    uploaded_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), insert_default=utcnow, init=False)
     
     # Relationships
-    user = relationship("User", back_populates="chat_memberships")
-    chat = relationship("Chat", back_populates="members")
+    message: Mapped["Message"] = relationship(back_populates="attachments", lazy="raise", init=False, repr=False)
 
 class BlacklistedToken(Base):
     __tablename__ = "blacklisted_tokens"
+    __table_args__ = (
+        # Вибірка/очищення записів за часом закінчення
+        Index("ix_blacklisted_expires", "expires_at"),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True, init=False)
+    jti: Mapped[str] = mapped_column(String(32), unique=True, index=True)  # jti токена, не сам JWT
+    blacklisted_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), insert_default=utcnow, init=False)
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
     
-    id = Column(Integer, primary_key=True, index=True)
-    token = Column(String, unique=True, index=True, nullable=False)
-    blacklisted_at = Column(DateTime(timezone=True), server_default=func.now())
-    expires_at = Column(DateTime(timezone=True), nullable=False)
-    
\ No newline at end of file
+@lru_cache(maxsize=None)
+def list_adapter(cls):
+    """Закешований TypeAdapter для списку відповідей (створення адаптера дороге)"""
+    return TypeAdapter(list[cls])
+
+# Запити гарячого шляху: побудовані один раз, кешуються за ідентичністю lambda,
+# значення передаються параметрами під час виконання
+user_by_email = lambda_stmt(lambda: select(User).where(User.email == bindparam("email")))
+
+# Автор підтягується тим самим запитом (лише id і username для UserRef);
+# решта зв'язків - raiseload, щоб не з'явився непомітний N+1
+chat_messages_page = lambda_stmt(lambda: select(Message).options(
+    joinedload(Message.author).load_only(User.id, User.username), raiseload("*")
+).where(
+    Message.chat_id == bindparam("chat_id"),
+    Message.is_deleted == False
+).order_by(Message.id.desc()).limit(bindparam("limit")))
+
+chat_messages_before = lambda_stmt(lambda: select(Message).options(
+    joinedload(Message.author).load_only(User.id, User.username), raiseload("*")
+).where(
+    Message.chat_id == bindparam("chat_id"),
+    Message.is_deleted == False,
+    Message.id < bindparam("before_id")
+).order_by(Message.id.desc()).limit(bindparam("limit")))
+
+# Повнотекстовий пошук (GIN-індекс по content_tsv)
+chat_messages_search = lambda_stmt(lambda: select(Message).options(
+    joinedload(Message.author).load_only(User.id, User.username), raiseload("*")
+).where(
+    Message.chat_id == bindparam("chat_id"),
+    Message.is_deleted == False,
+    Message.content_tsv.op("@@")(func.plainto_tsquery(literal_column("'simple'"), bindparam("query")))
+).order_by(Message.id.desc()).limit(bindparam("limit")))
+
+# Членство визначається самим рядком chats, без JOIN
+chat_participant_exists = lambda_stmt(lambda: select(exists().where(
+    Chat.id == bindparam("chat_id"),
+    or_(
+        (Chat.creator_id == bindparam("user_id")) & (Chat.creator_blocked == False),
+        (Chat.recipient_id == bindparam("user_id")) & (Chat.recipient_blocked == False)
+    )
+)))
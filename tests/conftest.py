@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Модулі застосунку лежать у корені репозиторію
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("JWT_SECRET", "test-secret-key-for-pytest-only-32b")
@@ -0,0 +1,59 @@
+"""Кеш користувачів у get_current_user не має тримати ORM-об'єкти сесії"""
+import asyncio
+
+import pytest
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import auth
+from models import User, UserResponse
+
+pytest.importorskip("aiosqlite")
+
+
+async def _not_blacklisted(jti: str) -> bool:
+    return False
+
+
+def _credentials(email: str) -> HTTPAuthorizationCredentials:
+    return HTTPAuthorizationCredentials(
+        scheme="Bearer", credentials=auth.create_access_token({"sub": email})
+    )
+
+
+async def _run_failed_flush_then_cached_lookup():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(User.__table__.create)
+    session_factory = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+    try:
+        async with session_factory() as db:
+            db.add(User(username="alice", email="alice@ex.com", password="x"))
+            await db.commit()
+
+        token = _credentials("alice@ex.com")
+
+        # Перший запит: промах кешу, після чого сесія відкочується
+        # (як при FK-помилці в POST /messages/{id}/files)
+        async with session_factory() as db:
+            first = await auth.get_current_user(token, db)
+            await db.rollback()
+
+        # Наступний запит бере користувача з кешу вже в іншій сесії
+        async with session_factory() as db:
+            cached = await auth.get_current_user(token, db)
+    finally:
+        await engine.dispose()
+    return first, cached
+
+
+def test_cached_user_survives_rollback_of_loading_session(monkeypatch):
+    monkeypatch.setattr(auth, "is_token_blacklisted", _not_blacklisted)
+    auth._user_cache.clear()
+
+    first, cached = asyncio.run(_run_failed_flush_then_cached_lookup())
+
+    assert (cached.username, cached.email) == ("alice", "alice@ex.com")
+    assert cached is first
+    assert not isinstance(cached, User)
+    assert UserResponse.model_validate(cached).id == cached.id